@@ -1,5 +1,6 @@
-from collections import OrderedDict, defaultdict
+from collections import defaultdict
 import abc
+import itertools
 
 from commands import SetConst, Var
 
@@ -16,6 +17,7 @@ class FuncWriter(metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
     def write_function(self, name, insns):
+        """insns is an iterable of commands, it may only be iterated once"""
         pass
 
     @abc.abstractmethod
@@ -40,6 +42,8 @@ class FuncWriter(metaclass=abc.ABCMeta):
 
 class CmdWriter:
 
+    __slots__ = ('pre', 'out', 'post', 'func_writer', 'temp_gen')
+
     def __init__(self, func_writer, temp_gen):
         self.pre = []
         self.out = []
@@ -57,7 +61,7 @@ class CmdWriter:
         self.out.append(cmd)
 
     def get_output(self):
-        return self.pre + self.out + self.post
+        return itertools.chain(self.pre, self.out, self.post)
 
     def allocate_temp(self):
         return self.temp_gen.next()
@@ -93,6 +97,8 @@ class TemporaryVarGen:
 
 class InstructionSeq:
 
+    __slots__ = ('insns', 'holder')
+
     def __init__(self, holder):
         self.insns = []
         self.holder = holder
@@ -104,6 +110,7 @@ class InstructionSeq:
         insn = self.validate_insn(insn)
         ret = insn.activate(self)
         self.insns.append(insn)
+        self.insn_added(insn)
         if with_name:
             assert ret is not None
             if type(with_name) == str:
@@ -121,18 +128,29 @@ class InstructionSeq:
         return len(self.insns) == 0
 
     def apply_mapping(self, arg_type, mapping):
-        for insn in self.insns:
+        if not mapping:
+            return
+        self._replace_args(self.insns, arg_type, mapping)
+
+    @staticmethod
+    def _replace_args(insns, arg_type, mapping):
+        """Replaces arg_type arguments of insns found in mapping, returns the
+        new values"""
+        replaced = []
+        for insn in insns:
             for arg in insn.query(arg_type):
                 val = arg.val
                 if val in mapping:
-                    arg.val = mapping[val]
+                    arg.val = new_val = mapping[val]
+                    replaced.append(new_val)
+        return replaced
 
     def transform(self, func):
         changed = False
         new_insns = []
         for insn in self.insns:
             new_insn = func(insn)
-            if not changed and new_insn != insn:
+            if not changed and new_insn is not insn:
                 changed = True
             if new_insn is not None:
                 if type(new_insn) == list:
@@ -140,10 +158,20 @@ class InstructionSeq:
                 else:
                     new_insns.append(new_insn)
         self.insns = new_insns
+        self.insns_changed()
         return changed
 
+    def insns_changed(self):
+        """Must be called after modifying self.insns directly"""
+        pass
+
+    def insn_added(self, insn):
+        self.insns_changed()
+
 class Preamble(InstructionSeq):
 
+    __slots__ = ('is_top',)
+
     def __init__(self, parent):
         super().__init__(parent)
         self.is_top = isinstance(parent, TopLevel)
@@ -152,29 +180,55 @@ class Preamble(InstructionSeq):
         assert insn.preamble_safe, insn
         return insn
 
+    def insns_changed(self):
+        if not self.is_top:
+            self.holder._inline_plans.pop(self, None)
+
     def apply(self, writer):
         for insn in self.insns:
             insn.apply(writer, self.holder)
 
     def serialize(self):
         indent = '' if self.is_top else '    '
-        insns = '\n'.join(indent + '    ' + insn.serialize(self.holder)
+        prefix = indent + '    '
+        holder = self.holder
+        insns = '\n'.join(prefix + insn.serialize(holder)
                           for insn in self.insns)
-        return indent + 'preamble {\n' + insns + '\n' + indent + '}\n'
+        return '%spreamble {\n%s\n%s}\n' % (indent, insns, indent)
 
     def __str__(self):
         return 'Preamble(%s)' % self.holder
 
-class Scope(OrderedDict):
+class Scope(dict):
+
+    # Unpickling sets items before __setstate__ restores the attributes
+    _inverse_dirty = True
 
     def __init__(self, parent=None):
         super().__init__()
+        # id(value) -> key, kept up to date on insert and rebuilt by
+        # for_value after deletes or replacements
         self.inverse_dict = {}
+        self._inverse_dirty = False
         self.parent = parent
 
     def __setitem__(self, key, value):
+        if not self._inverse_dirty:
+            if dict.__contains__(self, key):
+                # Replaced value may still be stored under another key
+                self._inverse_dirty = True
+            else:
+                self.inverse_dict[id(value)] = key
         super().__setitem__(key, value)
-        self.inverse_dict[value] = key
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._inverse_dirty = True
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Object ids do not survive pickling
+        self._inverse_dirty = True
 
     def __missing__(self, key):
         if self.parent is not None:
@@ -182,11 +236,16 @@ class Scope(OrderedDict):
         raise KeyError(key)
 
     def __contains__(self, key):
-        if super().__contains__(key):
+        if dict.__contains__(self, key):
             return True
-        if self.parent is not None:
-            return key in self.parent
-        return False
+        parent = self.parent
+        if parent is None:
+            return False
+        # Common case of a function scope under the top scope, avoid
+        # recursing into the parent's __contains__
+        if parent.parent is None:
+            return dict.__contains__(parent, key)
+        return key in parent
 
     def get_or_create(self, name, callback):
         if name not in self:
@@ -196,33 +255,41 @@ class Scope(OrderedDict):
         return val
 
     def get_no_parent(self, key):
-        if super().__contains__(key):
-            return self[key]
+        if self.contains_no_parent(key):
+            return dict.__getitem__(self, key)
         raise KeyError(key)
 
     def contains_no_parent(self, key):
-        return super().__contains__(key)
+        return dict.__contains__(self, key)
 
     def for_value(self, value, look_parent=True):
-        if value in self.inverse_dict:
-            return self.inverse_dict[value]
+        if self._inverse_dirty:
+            self.inverse_dict = {id(v): k for k, v in self.items()}
+            self._inverse_dirty = False
+        if id(value) in self.inverse_dict:
+            return self.inverse_dict[id(value)]
         if look_parent and self.parent is not None:
             return self.parent.for_value(value)
         raise KeyError(value)
 
 class VariableHolder:
 
+    __slots__ = ()
+
     def uniq_name(self, hint):
         if hint not in self.scope:
             return hint
-        i = 0
+        # Resume probing from the last suffix handed out for this hint
+        i = self._name_counter.get(hint, 0)
         while '%s%d' % (hint, i) in self.scope:
             i += 1
+        self._name_counter[hint] = i + 1
         return '%s%d' % (hint, i)
 
     def uniq(self, hint, callback):
         name = self.uniq_name(hint)
-        obj = self.scope[name] = callback(name)
+        obj = callback(name)
+        self.store(name, obj)
         return obj
 
     def generate_name(self, namehint, value):
@@ -232,6 +299,8 @@ class VariableHolder:
         assert not self.scope.contains_no_parent(name),  \
                '%s: %s' % (name, self.scope[name])
         self.scope[name] = value
+        if isinstance(value, Variable):
+            self._variables.append(value)
 
     def name_for(self, value):
         return self.scope.for_value(value)
@@ -256,12 +325,14 @@ class VariableHolder:
             else:
                 del self.scope[key]
         #self.scope = new_scope
+        if changed:
+            self._variables = [var for var in self.scope.values() \
+                               if isinstance(var, Variable)]
         return changed
 
     def reset_var_usage(self):
-        for var in self.scope.values():
-            if isinstance(var, Variable):
-                var.reset_usage()
+        for var in self._variables:
+            var.reset_usage()
 
 class Pragma(metaclass=abc.ABCMeta):
 
@@ -277,6 +348,10 @@ class TopLevel(VariableHolder):
 
     def __init__(self):
         self.scope = Scope()
+        self._name_counter = {}
+        self._variables = []
+        # Functions in scope order, maintained alongside the scope
+        self._functions = {}
         self.preamble = Preamble(self)
         self.finished = False
         self.store('pos_util', PosUtilEntity())
@@ -284,8 +359,30 @@ class TopLevel(VariableHolder):
         # Internal directives. Implementation defined.
         self.pragmas = []
 
+    def store(self, name, value):
+        super().store(name, value)
+        if isinstance(value, VisibleFunction):
+            self._functions[name] = value
+
+    def functions(self):
+        """(name, function) pairs of all functions in this scope"""
+        return self._functions.items()
+
+    def replace_function(self, name, func):
+        self.scope[name] = func
+        self._functions[name] = func
+
+    def transform_scope(self, func):
+        changed = super().transform_scope(func)
+        if changed:
+            self._functions = {name: var for name, var in self.scope.items() \
+                               if isinstance(var, VisibleFunction)}
+        return changed
+
     def get_or_create_func(self, name):
-        return self.scope.get_or_create(name, self._create_func)
+        if name not in self.scope:
+            self.store(name, self._create_func(name))
+        return self.scope[name]
 
     def create_function(self, namehint):
         return self.uniq(namehint, self._create_func)
@@ -296,10 +393,11 @@ class TopLevel(VariableHolder):
     def define_function(self, name):
         func = self.get_or_create_func(name)
         if isinstance(func, ExternFunction):
-            real_func = self.scope[name] = self._create_func(name)
+            real_func = self._create_func(name)
+            self.replace_function(name, real_func)
             real_func.expect_signature(func)
             mapping = {func: real_func}
-            for var in self.scope.values():
+            for var in self._functions.values():
                 if isinstance(var, IRFunction):
                     for block in var.allblocks:
                         block.apply_mapping(ExternFunction, mapping)
@@ -317,15 +415,14 @@ class TopLevel(VariableHolder):
         return func
 
     def include_from(self, other):
-        for name, var in other.scope.items():
-            if isinstance(var, VisibleFunction) and not name.startswith('__'):
-                self.scope[name] = ExternFunction(var.global_name, self)
+        for name, var in other.functions():
+            if not name.startswith('__'):
+                self.replace_function(name, ExternFunction(var.global_name, self))
 
     def end(self):
         assert not self.finished
-        for name, var in self.scope.items():
-            if isinstance(var, VisibleFunction):
-                assert var.finished, "unfinished function " + name
+        for name, var in self._functions.items():
+            assert var.finished, "unfinished function " + name
         self.finished = True
 
     def writeout(self, writer):
@@ -335,10 +432,9 @@ class TopLevel(VariableHolder):
         table = []
         functions = []
 
-        for name, var in self.scope.items():
-            if isinstance(var, VisibleFunction):
-                table.extend(var.get_func_table())
-                functions.append(var)
+        for var in self._functions.values():
+            table.extend(var.get_func_table())
+            functions.append(var)
         writer.write_func_table(table)
 
         temp_generator = TemporaryVarGen(writer)
@@ -356,9 +452,8 @@ class TopLevel(VariableHolder):
     def serialize(self):
         strs = []
         strs.append(self.preamble.serialize())
-        for elem in self.scope.values():
-            if isinstance(elem, VisibleFunction):
-                strs.append(elem.serialize())
+        for elem in self._functions.values():
+            strs.append(elem.serialize())
         return '\n'.join(strs)
 
     @staticmethod
@@ -369,37 +464,41 @@ class TopLevel(VariableHolder):
         if len(tops) == 1:
             return tops[0]
         out = TopLevel()
-        externs = defaultdict(list)
+        unresolved = defaultdict(list)
+        extern_mapping = {}
         all_blocks = []
         for top in tops:
             assert top.finished
             out.preamble.insns.extend(top.preamble.insns)
             out.pragmas.extend(top.pragmas)
             for name, var in top.scope.items():
-                if isinstance(var, VisibleFunction):
-                    if isinstance(var, ExternFunction):
-                        externs[name].append(var)
+                if isinstance(var, ExternFunction):
+                    # Resolve now if the concrete function has been seen
+                    concrete = out.lookup_func(name)
+                    if concrete is not None:
+                        var.expect_signature(concrete)
+                        extern_mapping[var] = concrete
                     else:
-                        # Name must be the same as global name
-                        out.store(name, var)
-                        # re-parent function scopes
-                        var.scope.parent = out.scope
-                        all_blocks.extend(var.blocks)
+                        unresolved[name].append(var)
+                elif isinstance(var, VisibleFunction):
+                    # Name must be the same as global name
+                    out.store(name, var)
+                    # re-parent function scopes
+                    var.scope.parent = out.scope
+                    all_blocks.extend(var.blocks)
                 else:
                     out.generate_name(name, var)
-        extern_mapping = {}
-        for name, externlist in externs.items():
-            new_extern = externlist[0]
+        for name, externlist in unresolved.items():
             concrete = out.lookup_func(name)
-            replacement = concrete or new_extern
+            replacement = concrete or externlist[0]
             for extern in externlist:
                 # Externs of the same name must have same signature
                 extern.expect_signature(replacement)
-                if replacement != extern:
+                if replacement is not extern:
                     extern_mapping[extern] = replacement
             if not concrete:
                 # Put any unresolved externs back
-                out.store(name, new_extern)
+                out.store(name, replacement)
         # Replace ExternFunction references in all blocks
         if extern_mapping:
             for block in all_blocks:
@@ -408,20 +507,29 @@ class TopLevel(VariableHolder):
         return out
 
     def run_pragmas(self, known_pragmas):
+        assert all(p_key in known_pragmas for p_key, _ in self.pragmas)
         final = {}
+        missing = object()
         for (p_key, p_val) in self.pragmas:
-            assert p_key in known_pragmas
-            if p_key in final:
-                final[p_key] = known_pragmas[p_key].reduce(final[p_key], p_val)
-            else:
-                final[p_key] = p_val
+            cur = final.get(p_key, missing)
+            if cur is not missing:
+                p_val = known_pragmas[p_key].reduce(cur, p_val)
+            final[p_key] = p_val
         results = {}
         for p_key, p_val in final.items():
             results[p_key] = known_pragmas[p_key].apply(self, p_val)
         return results
 
+# Literal argument type -> (expected parameter type, error message)
+_LITERAL_TYPES = {
+    int: (VarType.i32, "Literal int on non i32"),
+    float: (VarType.q10, "Literal float on non q10"),
+}
+
 class VisibleFunction(FunctionLike):
 
+    __slots__ = ()
+
     @property
     def finished(self):
         return False
@@ -432,6 +540,10 @@ class VisibleFunction(FunctionLike):
     def get_func_table(self):
         return []
 
+    @property
+    def signature(self):
+        return (tuple(self.params), tuple(self.returns))
+
     def writeout(self, writer, temp_gen):
         pass
 
@@ -441,10 +553,10 @@ class VisibleFunction(FunctionLike):
             assert args is not None, "Missing args"
             assert len(args) == len(self.params), "Incorrect number of args"
             for (ptype, ppass), argval in zip(self.params, args):
-                if type(argval) == int:
-                    assert ptype == VarType.i32, "Literal int on non i32"
-                elif type(argval) == float:
-                    assert ptype == VarType.q10, "Literal float on non q10"
+                literal = _LITERAL_TYPES.get(type(argval))
+                if literal is not None:
+                    expected, msg = literal
+                    assert ptype == expected, msg
                 else:
                     assert isinstance(argval, Variable), "Arg must be variable, got %s" % argval
                     assert argval.type == ptype, "Arg type mismatch"
@@ -468,12 +580,15 @@ class VisibleFunction(FunctionLike):
 
 class ExternFunction(VisibleFunction):
 
+    __slots__ = ('_gname', 'params', 'returns', '_signature')
+
     def __init__(self, global_name, params=None, returns=None):
         self._gname = global_name
         self.params = list(params or [])
         self.returns = list(returns or [])
         for (ptype, ppass) in self.params:
             assert ppass in ['byval', 'byref']
+        self._signature = (tuple(self.params), tuple(self.returns))
 
     @property
     def finished(self):
@@ -492,12 +607,15 @@ class ExternFunction(VisibleFunction):
         if not other.finished:
             other.expect_signature(self)
         else:
-            assert self.params == other.params
-            assert self.returns == other.returns
+            assert self.signature == other.signature
 
     def get_func_table(self):
         return []
 
+    @property
+    def signature(self):
+        return self._signature
+
     @property
     def extern_visibility(self):
         return True
@@ -531,10 +649,25 @@ class ExternFunction(VisibleFunction):
 
 class IRFunction(VisibleFunction, VariableHolder):
 
+    __slots__ = ('scope', '_name_counter', '_variables', '_name', 'preamble',
+                 '_blocks', '_blocks_cache', '_unterminated_blocks',
+                 '_finished', '_use',
+                 '_entryblock', '_exitblock', 'post_exit_insns',
+                 '_varsfinalized', '_registers', '_is_extern', '_is_pure',
+                 '_is_inline', '_inline_plans', 'params', 'returns',
+                 '__future_expect_sig')
+
     def __init__(self, name, top):
         self.scope = Scope(top.scope)
+        self._name_counter = {}
+        self._variables = []
         self._name = name
         self.preamble = Preamble(self)
+        # Blocks in scope order, maintained alongside the scope
+        self._blocks = []
+        self._blocks_cache = None
+        # Number of blocks (excluding entry and exit) not terminated
+        self._unterminated_blocks = 0
         self._finished = False
         self._use = 0
         # use "0" to avoid collision
@@ -543,15 +676,37 @@ class IRFunction(VisibleFunction, VariableHolder):
         self._exitblock = self.uniq('0ret', self._create_super_block)
         self.post_exit_insns = []
         self._varsfinalized = False
+        self._registers = None
         self._is_extern = False
         self._is_pure = False
         self._is_inline = False
+        # seq -> plan, see _inline_plan
+        self._inline_plans = {}
         self.params = []
         self.returns = []
         self.__future_expect_sig = []
 
     def _create_super_block(self, name):
-        return SuperBlock(name, self)
+        return self._add_block(SuperBlock(name, self))
+
+    def _add_block(self, block):
+        self._blocks.append(block)
+        self._blocks_cache = None
+        if not isinstance(block, SuperBlock):
+            self._unterminated_blocks += 1
+        return block
+
+    def transform_scope(self, func):
+        changed = super().transform_scope(func)
+        if changed:
+            self._blocks = [var for var in self.scope.values() \
+                            if isinstance(var, BasicBlock)]
+            self._blocks_cache = None
+            self._unterminated_blocks = sum(1 for block in self.blocks \
+                                            if not block._closed)
+            self._registers = None
+            self._inline_plans = {}
+        return changed
 
     def usage(self):
         self._use += 1
@@ -604,7 +759,7 @@ class IRFunction(VisibleFunction, VariableHolder):
     def is_defined(self):
         if not self._varsfinalized:
             return len(self.blocks) > 0
-        return len(self.allblocks) > 0
+        return len(self._blocks) > 0
 
     @property
     def finished(self):
@@ -621,19 +776,21 @@ class IRFunction(VisibleFunction, VariableHolder):
 
     @property
     def blocks(self):
-        return [block for block in self.allblocks if block not in [
-                    self._entryblock, self._exitblock]]
+        if self._blocks_cache is None:
+            entry, exit = self._entryblock, self._exitblock
+            self._blocks_cache = [block for block in self._blocks \
+                                  if block is not entry and block is not exit]
+        return self._blocks_cache
 
     @property
     def allblocks(self):
-        return [var for var in self.scope.values() if
-                isinstance(var, BasicBlock)]
+        return self._blocks
 
     def get_or_create_block(self, name):
         return self.scope.get_or_create(name, self._create_block)
 
     def _create_block(self, name):
-        return BasicBlock(name, self)
+        return self._add_block(BasicBlock(name, self))
 
     def create_block(self, namehint):
         block = self.uniq(namehint, self._create_block)
@@ -649,8 +806,8 @@ class IRFunction(VisibleFunction, VariableHolder):
         if not self.finished:
             self.__future_expect_sig.append(other)
             return
-        assert self.params == other.params, (self.params, other.params)
-        assert self.returns == other.returns, (self.returns, other.returns)
+        sig, other_sig = self.signature, other.signature
+        assert sig == other_sig, (sig, other_sig)
 
     def end(self):
         assert self.is_defined
@@ -662,35 +819,52 @@ class IRFunction(VisibleFunction, VariableHolder):
             self.expect_signature(other)
 
     def get_func_table(self):
-        return [block.global_name for block in self.allblocks] \
+        return [block.global_name for block in self._blocks] \
                + [self.global_name]
 
     def writeout(self, writer, temp_gen):
         assert self.finished
         self.preamble.apply(writer)
-        for block in self.allblocks:
+        for block in self._blocks:
             writer.write_function(block.global_name, block.writeout(writer,
                                                                     temp_gen))
 
     def get_registers(self):
         assert self._varsfinalized
-        return [var for var in self.scope.values() \
-                if isinstance(var, Variable) and var._direct_ref() \
-                and not var.is_entity_local]
+        if self._registers is None:
+            self._registers = [var for var in self._variables \
+                               if var._direct_ref() \
+                               and not var.is_entity_local]
+        return self._registers
 
     def is_closed(self):
-        return all(b.is_terminated() for b in self.blocks)
-
-    def _inline_seq(self, from_seq, to_seq, scope_mapping):
-        #print("inline", from_seq, "->", to_seq)
-        #print(from_seq.serialize())
+        return self._unterminated_blocks == 0
+
+    def _inline_plan(self, seq):
+        """Returns the instructions of seq to copy when inlining, paired with
+        the value name for constructors (None otherwise). Cached until
+        seq.insns_changed is called."""
+        plan = self._inline_plans.get(seq)
+        if plan is not None:
+            return plan
         from .instructions import ConstructorInsn
-        for insn in from_seq.insns:
+        plan = []
+        for insn in seq.insns:
             if not insn.inline_copyable:
                 continue
-            new_insn = insn.copy_with_changes(scope_mapping)
+            name = None
             if isinstance(insn, ConstructorInsn):
                 name = self.name_for(insn._value)
+            plan.append((insn, name))
+        self._inline_plans[seq] = plan
+        return plan
+
+    def _inline_seq(self, from_seq, to_seq, scope_mapping):
+        #print("inline", from_seq, "->", to_seq)
+        #print(from_seq.serialize())
+        for insn, name in self._inline_plan(from_seq):
+            new_insn = insn.copy_with_changes(scope_mapping)
+            if name is not None:
                 scope_mapping[insn._value] = to_seq.add(new_insn, True, name)
             else:
                 to_seq.add(new_insn)
@@ -711,7 +885,8 @@ class IRFunction(VisibleFunction, VariableHolder):
                 new_block = other.create_block(var._name)
                 scope_mapping[var] = new_block
                 block_mapping[var] = new_block
-                new_block.is_function = var.is_function
+                if var.is_function:
+                    new_block.set_is_function()
                 new_block.defined = var.defined
             elif isinstance(var, ParameterVariable):
                 arg_var = next(argiter)
@@ -779,6 +954,7 @@ class IRFunction(VisibleFunction, VariableHolder):
             for insn in self._exitblock.insns:
                 self._entryblock.add(insn)
             self._exitblock.insns = []
+            self._exitblock.insns_changed()
         # clear super, let optimizer have control
         self._entryblock.superclear()
         self._exitblock.superclear()
@@ -787,14 +963,16 @@ class IRFunction(VisibleFunction, VariableHolder):
     def add_entry_exit(self):
         from .instructions import PushNewStackFrame, PopStack, Branch
         # sorted from head to tail of stack
-        vars = sorted([var.var for var in self.scope.values() \
+        # (the allocator assigns offsets in scope order, so this is cheap)
+        vars = sorted([var.var for var in self._variables \
                 if isinstance(var, LocalVariable) \
                 and isinstance(var.var, NbtOffsetVariable)],
                       key=lambda v: v.offset)
         if vars:
             assert vars[0].offset == 0, "Stack tip not 0 in %s: %s" % (self._name, vars)
             assert vars[-1].offset == len(vars) - 1, "Stack base not length - 1"
-            assert len({v.offset for v in vars}) == len(vars), "Stack collision"
+            assert all(v.offset == i for i, v in enumerate(vars)), \
+                   "Stack collision"
             # Push the variable type - this initializes with the default value
             # TODO consider pushing initial value if known
             self._entryblock.add(PushNewStackFrame(tuple(var.type for var \
@@ -811,10 +989,10 @@ class IRFunction(VisibleFunction, VariableHolder):
         self._entryblock.add(RevokeEventAdvancement(self))
 
     def serialize(self):
+        blocks = self._blocks if self._varsfinalized else self.blocks
         return 'function %s {\n%s\n%s\n}\n' % (self._name,
                                                self.preamble.serialize(),
-           '\n\n'.join(block.serialize() for block in (self.allblocks if \
-                       self._varsfinalized else self.blocks)))
+                      '\n\n'.join(block.serialize() for block in blocks))
 
     def __str__(self):
         return 'Function(%s)' % (self._name)
@@ -822,6 +1000,9 @@ class IRFunction(VisibleFunction, VariableHolder):
 
 class BasicBlock(FunctionLike, InstructionSeq):
 
+    __slots__ = ('_name', '_func', 'needs_success_tracker', 'defined',
+                 'is_function', 'force', '_use', '_terminated', '_arg_index')
+
     def __init__(self, name, func):
         super().__init__(func)
         self._name = name
@@ -831,6 +1012,10 @@ class BasicBlock(FunctionLike, InstructionSeq):
         self.is_function = False
         self.force = False
         self._use = 0
+        # Whether the last instruction is a terminator
+        self._terminated = False
+        # arg type -> instructions with an argument of that type
+        self._arg_index = {}
 
     def usage(self):
         self._use += 1
@@ -842,7 +1027,18 @@ class BasicBlock(FunctionLike, InstructionSeq):
         return self._use
 
     def set_is_function(self):
+        was_closed = self._closed
         self.is_function = True
+        self._closed_changed(was_closed)
+
+    @property
+    def _closed(self):
+        return self.is_function or self._terminated
+
+    def _closed_changed(self, was_closed):
+        closed = self._closed
+        if closed != was_closed:
+            self._func._unterminated_blocks += -1 if closed else 1
 
     @property
     def global_name(self):
@@ -856,15 +1052,48 @@ class BasicBlock(FunctionLike, InstructionSeq):
 
     def is_terminated(self):
         assert self.defined
-        if self.is_function:
-            return True
-        if not self.insns:
-            return False
-        return self.insns[-1].terminator()
+        return self._closed
+
+    def insns_changed(self):
+        was_closed = self._closed
+        self._terminated = bool(self.insns and self.insns[-1].terminator())
+        self._arg_index = {}
+        self._closed_changed(was_closed)
+        self._func._inline_plans.pop(self, None)
+
+    def insn_added(self, insn):
+        # Incremental insns_changed for an append
+        terminated = bool(insn.terminator())
+        if terminated != self._terminated:
+            self._terminated = terminated
+            if not self.is_function:
+                self._closed_changed(not terminated)
+        if self._arg_index:
+            self._arg_index = {}
+        plans = self._func._inline_plans
+        if plans:
+            plans.pop(self, None)
+
+    def apply_mapping(self, arg_type, mapping):
+        if not mapping:
+            return
+        index = self._arg_index
+        if arg_type not in index:
+            index[arg_type] = [insn for insn in self.insns
+                               if any(True for _ in insn.query(arg_type))]
+        replaced = self._replace_args(index[arg_type], arg_type, mapping)
+        # Entries for other types the new values belong to may now be
+        # missing insns. The arg_type entry is still a superset.
+        for new_val in replaced:
+            for other_type in list(index):
+                if other_type is arg_type:
+                    continue
+                if isinstance(new_val, other_type):
+                    del index[other_type]
 
     def validate_insn(self, insn):
         from .instructions import Branch, Return
-        if not self.force and self.insns and self.insns[-1].terminator():
+        if not self.force and self._terminated:
             assert False, "Block %s is terminated by %s. Tried adding %s" % (
                 self, self.insns[-1], insn)
         if isinstance(insn, Return):
@@ -889,6 +1118,8 @@ class BasicBlock(FunctionLike, InstructionSeq):
 
 class SuperBlock(BasicBlock):
 
+    __slots__ = ('_clear', 'is_entry')
+
     def __init__(self, name, func):
         super().__init__(name, func)
         self.defined = True
@@ -912,6 +1143,10 @@ class SuperBlock(BasicBlock):
             return super().use_count()
         return 2 # prevent elimination and inlining
 
+    def _closed_changed(self, was_closed):
+        # Entry and exit blocks are not counted by the function
+        pass
+
     def superclear(self):
         self._clear = True
 
@@ -924,23 +1159,44 @@ class SuperBlock(BasicBlock):
 
 class ObjectFormat:
 
-    VERSION = "1.0.0"
+    VERSION = "1.1.0"
+    # Uncompressed header, checked before unpickling. Files written by
+    # other versions may not unpickle into the current classes at all
+    HEADER = b'CBAOBJ ' + VERSION.encode('ascii') + b'\n'
+    ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
 
     def __init__(self, top):
         self.top = top
-        self.__version = ObjectFormat.VERSION
 
     @staticmethod
     def load(data):
         import pickle
-        import zlib
-        obj = pickle.loads(zlib.decompress(data))
-        assert obj.__version == ObjectFormat.VERSION
-        return obj
+        header = ObjectFormat.HEADER
+        if data[:len(header)] != header:
+            raise ValueError("Incompatible object file, expected version %s"
+                             % ObjectFormat.VERSION)
+        data = data[len(header):]
+        if data[:4] == ObjectFormat.ZSTD_MAGIC:
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("Object file is zstd-compressed, "
+                                 "install zstandard to read it")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            import zlib
+            data = zlib.decompress(data)
+        return pickle.loads(data)
 
     @staticmethod
     def save(top):
         import pickle
-        import zlib
         obj = ObjectFormat(top)
-        return zlib.compress(pickle.dumps(obj))
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            import zstandard
+        except ImportError:
+            import zlib
+            return ObjectFormat.HEADER + zlib.compress(data)
+        return ObjectFormat.HEADER + \
+               zstandard.ZstdCompressor(level=3).compress(data)
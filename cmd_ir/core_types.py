@@ -4,12 +4,16 @@ import commands as c
 
 class InsnArg:
 
+    __slots__ = ()
+
     @classmethod
     def _init_from_parser(cls, value):
         return value
 
 class NativeType(InsnArg):
 
+    __slots__ = ()
+
     @classmethod
     def typename(cls):
         return cls.__name__
@@ -66,6 +70,8 @@ class VirtualString(NativeType):
 
 class FunctionLike(NativeType, metaclass=abc.ABCMeta):
 
+    __slots__ = ()
+
     @property
     @abc.abstractmethod
     def global_name(self):
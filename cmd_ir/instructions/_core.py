@@ -48,6 +48,9 @@ class InsnMeta(abc.ABCMeta):
 
 class Insn(metaclass=InsnMeta):
 
+    # Subclasses without __slots__ still get a __dict__
+    __slots__ = ('_real_arg_vals', 'in_seq', '_allow_set')
+
     __lookup_cache = {}
 
     @classmethod
@@ -246,6 +249,8 @@ class QueryResult:
 
 class VoidApplicationInsn(Insn):
 
+    __slots__ = ()
+
     is_virtual = True
 
     def apply(self, out, func):
@@ -253,6 +258,8 @@ class VoidApplicationInsn(Insn):
 
 class ConstructorInsn(VoidApplicationInsn):
 
+    __slots__ = ('_value',)
+
     args = []
     argnames = ''
     preamble_safe = True
@@ -277,6 +284,8 @@ class ConstructorInsn(VoidApplicationInsn):
 # Instruction that always returns one command
 class SingleCommandInsn(Insn, metaclass=abc.ABCMeta):
 
+    __slots__ = ()
+
     def single_command(self):
         return True
 
@@ -292,6 +301,8 @@ class SingleCommandInsn(Insn, metaclass=abc.ABCMeta):
 
 class PreambleOnlyInsn:
 
+    __slots__ = ()
+
     preamble_safe = True
     top_preamble_only = False
     func_preamble_only = False
@@ -1,5 +1,7 @@
 """Events"""
 
+import sys
+
 from ._core import PreambleOnlyInsn, ConstructorInsn, Insn, SingleCommandInsn
 from ..core_types import (VirtualString,
                           EventRef,
@@ -9,78 +11,107 @@ from ..core_types import (VirtualString,
 from ..core import IRFunction, VisibleFunction
 import commands as c
 
+# Events dispatched through function tags rather than advancements
+_BUILTIN_EVENTS = frozenset((sys.intern('minecraft:tick'),
+                             sys.intern('minecraft:load')))
+
 class CreateEvent(PreambleOnlyInsn, ConstructorInsn):
     """Creates a new event object."""
 
-    args = [VirtualString]
+    __slots__ = ()
+
+    args = (VirtualString,)
     argnames = 'event_name'
-    argdocs = ["The event name"]
+    argdocs = ("The event name",)
     rettype = EventRef
     top_preamble_only = True
     insn_name = 'event'
 
     def construct(self):
-        return EventRef(str(self.event_name))
+        # Each event carries its own conditions, so only the name is shared
+        return EventRef(sys.intern(str(self.event_name)))
 
 class AddEventCondition(PreambleOnlyInsn, Insn):
     """Add a condition to an event that must be true for the event handler
     to be invoked."""
 
+    __slots__ = ('_cond_path', '_cond_value')
+
     is_virtual = True
 
-    args = [EventRef, VirtualString, VirtualString]
+    args = (EventRef, VirtualString, VirtualString)
     argnames = 'event path value'
-    argdocs = ["Event to add the condition to", "JSON path in the advancement",
-               "Value that must match"]
+    argdocs = ("Event to add the condition to", "JSON path in the advancement",
+               "Value that must match")
     top_preamble_only = True
     insn_name = 'add_event_condition'
 
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._set_condition()
+
+    def _set_condition(self):
+        self._cond_path = tuple(str(self.path).split('.'))
+        self._cond_value = str(self.value)
+
+    def changed(self, prop):
+        if prop in ('path', 'value'):
+            self._set_condition()
+
     def apply(self, out, top):
-        # TODO put in activate
-        self.event.add_condition(tuple(str(self.path).split('.')),
-                                 str(self.value))
+        self.event.add_condition(self._cond_path, self._cond_value)
 
 class EventHandler(PreambleOnlyInsn, Insn):
     """Add an event handler to the given event specification."""
 
-    args = [IRFunction, EventRef]
+    __slots__ = ()
+
+    args = (IRFunction, EventRef)
     argnames = 'handler event'
-    argdocs = ["Event handler", "Event"]
+    argdocs = ("Event handler", "Event")
     top_preamble_only = True
     insn_name = 'event_handler'
 
     def activate(self, seq):
-        if self.event.name not in ['minecraft:tick', 'minecraft:load']:
+        if self.event.name not in _BUILTIN_EVENTS:
             self.handler.add_advancement_revoke(self.event)
 
     def declare(self):
         self.handler.usage()
 
     def apply(self, out, top):
-        assert not self.handler.is_inline
-        out.write_event_handler(self.handler, self.event)
+        # Checked here rather than in declare, which is skipped at -O0
+        handler = self.handler
+        assert not handler.is_inline
+        out.write_event_handler(handler, self.event)
 
 class RevokeEventAdvancement(SingleCommandInsn):
     """(Internal) Revokes an advancement to allow an event to re-fire."""
 
-    args = [IRFunction]
+    __slots__ = ()
+
+    args = (IRFunction,)
     argnames = 'func'
-    argdocs = ["Handler"]
+    argdocs = ("Handler",)
     insn_name = 'revoke_event_adv'
 
+    # The revoke target is always the sender
+    _sender = Selector.new(SelectorType.SENDER).as_resolve()
+
     def get_cmd(self):
         # Advancement name = handler func name
-        return c.Advancement('revoke', Selector.new(SelectorType.SENDER) \
-                             .as_resolve(),
+        return c.Advancement('revoke', self._sender,
                            'only', c.AdvancementRef(self.func.global_name))
 
 class SetupInsn(PreambleOnlyInsn, Insn):
     """Tags a function as being part of the setup phase. It is called whenever
     the datapack is reloaded."""
 
-    args = [VisibleFunction]
+    __slots__ = ()
+
+    args = (VisibleFunction,)
     argnames = 'func'
-    argdocs = ["The setup function"]
+    argdocs = ("The setup function",)
     top_preamble_only = True
     insn_name = 'setupfn'
 
@@ -88,5 +119,6 @@ class SetupInsn(PreambleOnlyInsn, Insn):
         self.func.usage()
 
     def apply(self, out, top):
-        assert not self.func.is_inline
-        out.write_setup_function(self.func)
+        func = self.func
+        assert not func.is_inline
+        out.write_setup_function(func)
@@ -3,41 +3,48 @@
 from ._core import PreambleOnlyInsn, VoidApplicationInsn
 from .control_flow import RunDeferredCallback
 
-class ExternInsn(PreambleOnlyInsn, VoidApplicationInsn):
-    """Marks the function as externally visible. The function will not
-    be removed during optimization."""
+# Holds no per-function state so one instance is shared by all functions
+_deferred_callback = RunDeferredCallback()
+
+class FunctionFlagInsn(PreambleOnlyInsn, VoidApplicationInsn):
+    """Base of the instructions that set a flag on the function."""
 
-    args = []
+    __slots__ = ()
+
+    args = ()
     argnames = ''
     func_preamble_only = True
     inline_copyable = False
+
+class ExternInsn(FunctionFlagInsn):
+    """Marks the function as externally visible. The function will not
+    be removed during optimization."""
+
+    __slots__ = ()
+
     insn_name = 'extern'
 
     def activate(self, seq):
         seq.holder.set_extern(True)
 
-class PureInsn(PreambleOnlyInsn, VoidApplicationInsn):
+class PureInsn(FunctionFlagInsn):
     """Marks the function as a pure function (i.e. no side-effects). No checks
     are done to ensure it is side-effect free, allowing for functions with
     irrelevant side-effects (e.g. caching) to be marked as pure."""
 
-    args = []
-    argnames = ''
-    func_preamble_only = True
-    inline_copyable = False
+    __slots__ = ()
+
     insn_name = 'pure_func'
 
     def activate(self, seq):
         seq.holder.set_pure()
 
-class InlineInsn(PreambleOnlyInsn, VoidApplicationInsn):
+class InlineInsn(FunctionFlagInsn):
     """Marks the function as inline-able. invoke calls to this function will
     result in the body of the function being inserted at the call site"""
 
-    args = []
-    argnames = ''
-    func_preamble_only = True
-    inline_copyable = False
+    __slots__ = ()
+
     insn_name = 'inline'
 
     def activate(self, seq):
@@ -48,11 +55,16 @@ class RunCallbackOnExit(PreambleOnlyInsn, VoidApplicationInsn):
     does not return immediately, but instead invokes a callback
     when it eventually exits. Call this function with deferred_invoke."""
 
-    args = []
+    __slots__ = ()
+
+    args = ()
     argnames = ''
     func_preamble_only = True
     inline_copyable = False
     insn_name = 'run_callback_on_exit'
 
     def activate(self, seq):
-        seq.holder.post_exit_insns.append(RunDeferredCallback())
+        post_exit = seq.holder.post_exit_insns
+        # The callback only needs to run once per exit
+        if _deferred_callback not in post_exit:
+            post_exit.append(_deferred_callback)
@@ -221,6 +221,7 @@ class InvokeInliner(BlockVisitor):
             insn.declare()
         if self.reattach_block is not None:
             self.reattach_block.insns.append(insn)
+            self.reattach_block.insns_changed()
             insn = None
         self.reattach_block = new_attach
         return insn
@@ -50,13 +50,13 @@ class BuildProgram(Interpreter):
                 # This is a forward-referenced function, replace references
                 # with our extern
                 mapping = {existing: extern}
-                for var in self.top.scope.values():
+                for _, var in self.top.functions():
                     if isinstance(var, IRFunction):
                         var.preamble.apply_mapping(IRFunction, mapping)
                         for block in var.blocks:
                             block.apply_mapping(IRFunction, mapping)
                 # Direct replacement
-                self.top.scope[name] = extern
+                self.top.replace_function(name, extern)
         else:
             self.top.store(name, extern)
 